@@ -6,7 +6,6 @@ from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib import pwd
-from passlib.context import CryptContext
 
 import app.models as models
 import app.schemas as schemas
@@ -17,17 +16,15 @@ load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
 
-pwd_context = CryptContext(schemes=["bcrypt"])
-
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return models.pwd_context.verify(plain_password, hashed_password)
 
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return models.pwd_context.hash(password)
 
 
 def get_user(db, username: str):
@@ -51,7 +48,7 @@ def create_access_token(data: dict, expires_delta: timedelta):
     return encoded_jwt
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: SessionLocal = Depends(get_db)):
+def get_current_user(token: str = Depends(oauth2_scheme), db: SessionLocal = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Credenziali non valide.",
@@ -99,7 +96,7 @@ async def get_current_user_id(token: str = Depends(oauth2_scheme)):
 
 
 def reset_password(db: SessionLocal, user_id: int):
-    user = db.query(models.User).get(user_id)
+    user = db.get(models.User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="Utente non trovato.")
     tmp_password = pwd.genword()
@@ -108,4 +105,3 @@ def reset_password(db: SessionLocal, user_id: int):
     user.hashed_password = tmp_password_hashed
     db.add(user)
     db.commit()
-    db.refresh(user)
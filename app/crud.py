@@ -1,36 +1,77 @@
 import datetime
-from typing import Optional
+import logging
+from threading import Lock
+from typing import Optional, List
 from zoneinfo import ZoneInfo
 
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
 from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
 from passlib import pwd
-from sqlalchemy import extract, or_, and_, func, Float, text, desc
-from sqlalchemy.orm import aliased
+from sqlalchemy import extract, or_, and_, func, Float, Integer, text, desc, select, bindparam, update, cast, exists, \
+    insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased, selectinload, contains_eager
 
 import app.auth as auth
 import app.models as models
 import app.schemas as schemas
 from app.database import SessionLocal
 
+_plants_by_client = select(models.Plant).where(models.Plant.client_id == bindparam("client_id"))
+_machines_by_plant = select(models.Machine).where(models.Machine.plant_id == bindparam("plant_id")).order_by(
+    models.Machine.code)
+_user_by_id = select(models.User, models.Role.name.label('role'), models.Client.name.label('client_name'),
+                     models.Client.city.label('client_city')).join(
+    models.Role, models.User.role_id == models.Role.id).join(
+    models.Client, models.User.client_id == models.Client.id).where(models.User.id == bindparam("user_id"))
+_report_of_work = exists().where(models.Report.work_id == bindparam("work_id"),
+                                 models.Report.type == bindparam("type")).select()
+
+_cache_lock = Lock()
+_months_cache = TTLCache(maxsize=256, ttl=60)
+_machines_cache = TTLCache(maxsize=256, ttl=60)
+
+logger = logging.getLogger(__name__)
+_missing_indexes = set()
+
+
+def create_indexes(bind):
+    with bind.begin() as connection:
+        connection.execute(text("DROP INDEX IF EXISTS ix_report_op_date"))
+    for table in models.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=bind, checkfirst=True)
+            except IntegrityError:
+                _missing_indexes.add(index.name)
+                logger.warning("Indice %s non creato su %s: valori duplicati", index.name, table.name)
+
+
+def _clear_cache(cache: TTLCache):
+    with _cache_lock:
+        cache.clear()
+
 
 def get_plant_by_client(db: SessionLocal, client_id: int):
-    return db.query(models.Plant).filter(models.Plant.client_id == client_id).all()
+    return db.execute(_plants_by_client, {"client_id": client_id}).scalars().all()
 
 
 def get_machine_by_plant(db: SessionLocal, plant_id: int):
-    return db.query(models.Machine).filter(models.Machine.plant_id == plant_id).order_by(models.Machine.code).all()
+    return db.execute(_machines_by_plant, {"plant_id": plant_id}).scalars().all()
 
 
 def create_machine(db: SessionLocal, machine: schemas.MachineCreate):
-    db_machine = models.Machine(date_created=datetime.datetime.now(ZoneInfo("Europe/Rome")), name=machine.name,
-                                code=machine.code,
+    db_machine = models.Machine(name=machine.name, code=machine.code,
                                 brand=machine.brand, model=machine.model, serial_number=machine.serial_number,
                                 production_year=machine.production_year, cost_center=machine.cost_center,
                                 description=machine.description, plant_id=machine.plant_id,
                                 robotic_island=machine.robotic_island)
     db.add(db_machine)
     db.commit()
-    db.refresh(db_machine)
+    _clear_cache(_machines_cache)
     return db_machine
 
 
@@ -40,6 +81,8 @@ def get_plants(db: SessionLocal):
         models.Plant.id).all()
 
 
+@cached(_machines_cache, lock=_cache_lock,
+        key=lambda db, sort=None, limit=None, order=None, q=None: hashkey(sort, limit, order, q))
 def get_machines(db: SessionLocal, sort: Optional[str] = None, limit: Optional[int] = None,
                  order: Optional[str] = None, q: Optional[str] = None):
     query = db.query(models.Machine, models.Plant, models.Client).join(models.Plant,
@@ -61,91 +104,120 @@ def get_machines(db: SessionLocal, sort: Optional[str] = None, limit: Optional[i
                                  models.Plant.city.ilike(f"%{q}%"),
                                  models.Plant.address.ilike(f"%{q}%"),
                                  models.Client.name.ilike(f"%{q}%")))
-    return query.limit(limit).all()
-
-
-def get_reports(db: SessionLocal, user_id: Optional[int] = None, limit: Optional[int] = None):
-    query = db.query(
-        models.Report,
-        models.Commission.id.label("commission_id"),
-        models.Commission.code.label("commission_code"),
-        models.Machine.id.label("machine_id"),
-        models.Machine.name.label("machine_name"),
-        models.Machine.brand.label("machine_brand"),
-        models.Machine.code.label("machine_code"),
-        models.Machine.cost_center.label("cost_center"),
-        models.User.id.label("operator_id"),
-        models.User.first_name,
-        models.User.last_name,
-        models.Client.id.label("client_id"),
-        models.Client.name.label("client_name"),
-        models.Plant.id.label("plant_id"),
-        models.Plant.city.label("plant_city"),
-        models.Plant.address.label("plant_address")
-    ).select_from(models.Report).outerjoin(models.Commission,
-                                           and_(models.Report.type == "commission",
-                                                models.Report.work_id == models.Commission.id)).outerjoin(
-        models.Machine, and_(models.Report.type == "machine",
-                             models.Report.work_id == models.Machine.id)).join(models.User,
-                                                                               models.Report.operator_id == models.
-                                                                               User.id).outerjoin(
-        models.Plant, and_(models.Report.type == "machine", models.Machine.plant_id == models.Plant.id)).join(
-        models.Client,
-        or_(models.Commission.client_id == models.Client.id,
-            and_(models.Plant.client_id == models.Client.id,
-                 models.Report.type == "machine")))
+    return jsonable_encoder(query.limit(limit).all())
+
+
+_REPORT_OPTIONS = (
+    selectinload(models.Report.operator).load_only(models.User.first_name, models.User.last_name),
+    selectinload(models.Report.commission).load_only(models.Commission.code, models.Commission.client_id).selectinload(
+        models.Commission.client).load_only(models.Client.name),
+    selectinload(models.Report.machine).load_only(models.Machine.name, models.Machine.brand, models.Machine.code,
+                                                  models.Machine.cost_center, models.Machine.plant_id).selectinload(
+        models.Machine.plant).load_only(models.Plant.city, models.Plant.address, models.Plant.client_id).selectinload(
+        models.Plant.client).load_only(models.Client.name),
+)
+_REPORT_DETAIL_OPTIONS = (
+    selectinload(models.Report.operator),
+    selectinload(models.Report.supervisor),
+    selectinload(models.Report.commission).selectinload(models.Commission.client),
+    selectinload(models.Report.machine).selectinload(models.Machine.plant).selectinload(models.Plant.client),
+)
+
+
+def _report_client(report: models.Report):
+    if report.commission:
+        return report.commission.client
+    if report.machine and report.machine.plant:
+        return report.machine.plant.client
+    return None
+
+
+def _report_row(report: models.Report):
+    commission = report.commission
+    machine = report.machine
+    plant = machine.plant if machine else None
+    client = _report_client(report)
+    operator = report.operator
+    return {
+        "Report": {column.key: getattr(report, column.key) for column in models.Report.__table__.columns},
+        "commission_id": commission.id if commission else None,
+        "commission_code": commission.code if commission else None,
+        "machine_id": machine.id if machine else None,
+        "machine_name": machine.name if machine else None,
+        "machine_brand": machine.brand if machine else None,
+        "machine_code": machine.code if machine else None,
+        "cost_center": machine.cost_center if machine else None,
+        "operator_id": operator.id if operator else None,
+        "first_name": operator.first_name if operator else None,
+        "last_name": operator.last_name if operator else None,
+        "client_id": client.id if client else None,
+        "client_name": client.name if client else None,
+        "plant_id": plant.id if plant else None,
+        "plant_city": plant.city if plant else None,
+        "plant_address": plant.address if plant else None,
+    }
+
+
+def get_reports(db: SessionLocal, user_id: Optional[int] = None, limit: Optional[int] = None,
+                offset: Optional[int] = None):
+    query = db.query(models.Report).options(*_REPORT_OPTIONS).filter(
+        models.Report.operator.has(),
+        or_(models.Report.commission.has(models.Commission.client.has()),
+            models.Report.machine.has(models.Machine.plant.has(models.Plant.client.has()))))
     if user_id:
         query = query.filter(models.Report.operator_id == user_id)
-    return query.order_by(models.Report.date.desc()).limit(limit).all()
+    query = query.order_by(models.Report.date.desc(), models.Report.id.desc()).limit(limit).offset(offset)
+    return [_report_row(report) for report in query.all()]
 
 
 def get_report_by_id(db: SessionLocal, report_id: int):
-    supervisor = aliased(models.User)
-    return db.query(
-        models.Report,
-        models.Commission.id.label("commission_id"),
-        models.Commission.code.label("commission_code"),
-        models.Commission.description.label("commission_description"),
-        models.Machine.id.label("machine_id"),
-        models.Machine.name.label("machine_name"),
-        models.Machine.brand.label("machine_brand"),
-        models.Machine.code.label("machine_code"),
-        models.Machine.cost_center.label("cost_center"),
-        models.User.id.label("operator_id"),
-        models.User.first_name,
-        models.User.last_name,
-        models.Client.id.label("client_id"),
-        models.Client.name.label("client_name"),
-        models.Client.city.label("client_city"),
-        models.Plant.id.label("plant_id"),
-        models.Plant.name.label("plant_name"),
-        models.Plant.city.label("plant_city"),
-        models.Plant.address.label("plant_address"),
-        supervisor.id.label("supervisor_id"),
-        supervisor.first_name.label("supervisor_first_name"),
-        supervisor.last_name.label("supervisor_last_name")
-    ).select_from(models.Report).outerjoin(
-        models.Commission,
-        and_(models.Report.type == "commission", models.Report.work_id == models.Commission.id)).outerjoin(
-        models.Machine, and_(models.Report.type == "machine", models.Report.work_id == models.Machine.id)).join(
-        models.User, models.Report.operator_id == models.User.id).outerjoin(
-        models.Plant, models.Machine.plant_id == models.Plant.id
-    ).join(
-        models.Client,
-        or_(models.Plant.client_id == models.Client.id, models.Commission.client_id == models.Client.id)
-    ).join(supervisor, models.Report.supervisor_id == supervisor.id
-           ).filter(models.Report.id == report_id).first()
+    report = db.get(models.Report, report_id, options=_REPORT_DETAIL_OPTIONS)
+    if not report:
+        return None
+    client = _report_client(report)
+    supervisor = report.supervisor
+    if not report.operator or not client or not supervisor:
+        return None
+    plant = report.machine.plant if report.machine else None
+    row = _report_row(report)
+    row.update({
+        "commission_description": report.commission.description if report.commission else None,
+        "client_city": client.city,
+        "plant_name": plant.name if plant else None,
+        "supervisor_id": supervisor.id,
+        "supervisor_first_name": supervisor.first_name,
+        "supervisor_last_name": supervisor.last_name,
+    })
+    return row
+
+
+def _month_bounds(month: str):
+    start_date = datetime.datetime.strptime(month, "%m/%Y").date()
+    end_date = datetime.date(start_date.year + start_date.month // 12, start_date.month % 12 + 1, 1)
+    return start_date, end_date
 
 
+def _parse_date(value: Optional[str]):
+    if not value:
+        return None
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Data non valida")
+
+
+@cached(_months_cache, lock=_cache_lock, key=lambda db, user_id=None, client_id=None: hashkey(user_id, client_id))
 def get_months(db: SessionLocal, user_id: Optional[int] = None, client_id: Optional[int] = None):
-    query = db.query(models.Report.date)
+    year = cast(extract('year', models.Report.date), Integer).label('year')
+    month = cast(extract('month', models.Report.date), Integer).label('month')
+    query = db.query(year, month)
     if user_id:
         query = query.filter(models.Report.operator_id == user_id)
     if client_id:
-        query = query.filter(models.Client.id == client_id)
-    query = query.group_by(models.Report.date).order_by(models.Report.date)
-    dates = query.all()
-    return sorted(set([datetime.datetime.strftime(date[0], "%m/%Y") for date in dates]))
+        query = query.filter(or_(models.Report.commission.has(client_id=client_id),
+                                 models.Report.machine.has(models.Machine.plant.has(client_id=client_id))))
+    rows = query.distinct().order_by(year, month).all()
+    return [f"{row.month:02d}/{row.year}" for row in rows]
 
 
 def get_monthly_reports(db: SessionLocal, month: Optional[str] = '0', user_id: Optional[int] = 0,
@@ -187,11 +259,8 @@ def get_monthly_reports(db: SessionLocal, month: Optional[str] = '0', user_id: O
         or_(models.Plant.client_id == models.Client.id, models.Commission.client_id == models.Client.id)
     ).join(supervisor, models.Report.supervisor_id == supervisor.id)
     if month != '0':
-        start_date = datetime.datetime.strptime(month, "%m/%Y").date()
-        query = query.filter(
-            extract('month', models.Report.date) == start_date.month,
-            extract('year', models.Report.date) == start_date.year
-        )
+        start_date, end_date = _month_bounds(month)
+        query = query.filter(models.Report.date >= start_date, models.Report.date < end_date)
     if user_id:
         query = query.filter(models.Report.operator_id == user_id)
     if client_id:
@@ -244,18 +313,11 @@ def get_interval_reports(db: SessionLocal, start_date: Optional[str] = None, end
         models.Client,
         or_(models.Plant.client_id == models.Client.id, models.Commission.client_id == models.Client.id)
     ).join(supervisor, models.Report.supervisor_id == supervisor.id)
-    if start_date != '' and end_date != '':
-        start_date_dt = datetime.datetime.strptime(start_date, "%Y-%m-%d")
-        end_date_dt = datetime.datetime.strptime(end_date, "%Y-%m-%d")
-        query = query.filter(models.Report.date >= start_date_dt,
-                             models.Report.date <= end_date_dt)
-    else:
-        if start_date != '':
-            start_date_dt = datetime.datetime.strptime(start_date, "%Y-%m-%d")
-            query = query.filter(models.Report.date >= start_date_dt)
-        if end_date != '':
-            end_date_dt = datetime.datetime.strptime(end_date, "%Y-%m-%d")
-            query = query.filter(models.Report.date <= end_date_dt)
+    start_date, end_date = _parse_date(start_date), _parse_date(end_date)
+    if start_date:
+        query = query.filter(models.Report.date >= start_date)
+    if end_date:
+        query = query.filter(models.Report.date <= end_date)
     if user_id:
         query = query.filter(models.Report.operator_id == user_id)
     if client_id:
@@ -292,11 +354,8 @@ def get_monthly_commission_reports(db: SessionLocal, month: str, user_id: Option
         models.Client, models.Commission.client_id == models.Client.id
     ).join(supervisor, models.Report.supervisor_id == supervisor.id)
     if month != '0':
-        start_date = datetime.datetime.strptime(month, "%m/%Y").date()
-        query = query.filter(
-            extract('month', models.Report.date) == start_date.month,
-            extract('year', models.Report.date) == start_date.year
-        )
+        start_date, end_date = _month_bounds(month)
+        query = query.filter(models.Report.date >= start_date, models.Report.date < end_date)
     if user_id:
         query = query.filter(models.Report.operator_id == user_id)
     if client_id:
@@ -329,18 +388,11 @@ def get_interval_commission_reports(db: SessionLocal, start_date: Optional[str]
     ).join(models.User, models.Report.operator_id == models.User.id).join(
         models.Client, models.Commission.client_id == models.Client.id
     ).join(supervisor, models.Report.supervisor_id == supervisor.id)
-    if start_date != '' and end_date != '':
-        start_date_dt = datetime.datetime.strptime(start_date, "%Y-%m-%d")
-        end_date_dt = datetime.datetime.strptime(end_date, "%Y-%m-%d")
-        query = query.filter(models.Report.date >= start_date_dt,
-                             models.Report.date <= end_date_dt)
-    else:
-        if start_date != '':
-            start_date_dt = datetime.datetime.strptime(start_date, "%Y-%m-%d")
-            query = query.filter(models.Report.date >= start_date_dt)
-        if end_date != '':
-            end_date_dt = datetime.datetime.strptime(end_date, "%Y-%m-%d")
-            query = query.filter(models.Report.date <= end_date_dt)
+    start_date, end_date = _parse_date(start_date), _parse_date(end_date)
+    if start_date:
+        query = query.filter(models.Report.date >= start_date)
+    if end_date:
+        query = query.filter(models.Report.date <= end_date)
     if user_id:
         query = query.filter(models.Report.operator_id == user_id)
     if client_id:
@@ -351,11 +403,10 @@ def get_interval_commission_reports(db: SessionLocal, start_date: Optional[str]
 
 
 def get_daily_hours_in_month(db: SessionLocal, month: str, user_id: int):
-    start_date = datetime.datetime.strptime(month, "%m/%Y").date()
-    end_date = (start_date.replace(day=1) + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+    start_date, end_date = _month_bounds(month)
     dates = []
     current_date = start_date
-    while current_date <= end_date:
+    while current_date < end_date:
         dates.append(current_date)
         current_date += datetime.timedelta(days=1)
     query = db.query(
@@ -364,7 +415,7 @@ def get_daily_hours_in_month(db: SessionLocal, month: str, user_id: int):
         func.count().label('count')
     ).filter(
         models.Report.date >= start_date,
-        models.Report.date < end_date + datetime.timedelta(days=1),
+        models.Report.date < end_date,
         models.Report.operator_id == user_id
     ).group_by(
         func.date_trunc('day', models.Report.date)
@@ -385,27 +436,19 @@ def get_daily_hours_in_month(db: SessionLocal, month: str, user_id: int):
 
 
 def edit_report(db: SessionLocal, report_id: int, report: schemas.ReportCreate, user_id: int):
-    db_report = db.query(models.Report).filter(models.Report.id == report_id).first()
-    if db_report:
-        db_report.type = report.type
-        db_report.date = report.date
-        db_report.intervention_duration = report.intervention_duration
-        db_report.intervention_type = report.intervention_type
-        db_report.intervention_location = report.intervention_location
-        db_report.work_id = report.work_id
-        db_report.supervisor_id = report.supervisor_id
-        db_report.description = report.description
-        db_report.notes = report.notes
-        db_report.trip_kms = report.trip_kms
-        db_report.cost = report.cost
-        db_report.operator_id = user_id
-        db.commit()
-        return db_report
-    return {"detail": "Errore"}, 400
+    data = report.dict(exclude={'date_created'})
+    data['operator_id'] = user_id
+    result = db.execute(update(models.Report).where(models.Report.id == report_id).values(**data).execution_options(
+        synchronize_session=False))
+    db.commit()
+    _clear_cache(_months_cache)
+    if result.rowcount == 0:
+        return {"detail": "Errore"}, 400
+    return {"id": report_id, **data}
 
 
 def edit_client(db: SessionLocal, client_id: int, client: schemas.ClientCreate):
-    db_client = db.query(models.Client).filter(models.Client.id == client_id).first()
+    db_client = db.get(models.Client, client_id)
     if db_client:
         db_client.name = client.name
         db_client.city = client.city
@@ -416,24 +459,29 @@ def edit_client(db: SessionLocal, client_id: int, client: schemas.ClientCreate):
         db_client.province = client.province
         db_client.cap = client.cap
         db.commit()
+        _clear_cache(_machines_cache)
         return db_client
     return {"detail": "Errore"}, 400
 
 
 def edit_commission(db: SessionLocal, commission_id: int, commission: schemas.CommissionCreate):
-    db_commission = db.query(models.Commission).filter(models.Commission.id == commission_id).first()
+    db_commission = db.get(models.Commission, commission_id)
     if db_commission:
         db_commission.client_id = commission.client_id
         db_commission.code = commission.code
         db_commission.description = commission.description
         db_commission.open = commission.open
-        db.commit()
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            raise HTTPException(status_code=400, detail="Codice commessa già registrato")
         return db_commission
     return {"detail": "Errore"}, 400
 
 
 def edit_plant(db: SessionLocal, plant_id: int, plant: schemas.PlantCreate):
-    db_plant = db.query(models.Plant).filter(models.Plant.id == plant_id).first()
+    db_plant = db.get(models.Plant, plant_id)
     if db_plant:
         db_plant.client_id = plant.client_id
         db_plant.name = plant.name
@@ -445,12 +493,13 @@ def edit_plant(db: SessionLocal, plant_id: int, plant: schemas.PlantCreate):
         db_plant.province = plant.province
         db_plant.cap = plant.cap
         db.commit()
+        _clear_cache(_machines_cache)
         return db_plant
     return {"detail": "Errore"}, 400
 
 
 def edit_machine(db: SessionLocal, machine_id: int, machine: schemas.MachineCreate):
-    db_machine = db.query(models.Machine).filter(models.Machine.id == machine_id).first()
+    db_machine = db.get(models.Machine, machine_id)
     if db_machine:
         db_machine.plant_id = machine.plant_id
         db_machine.robotic_island = machine.robotic_island
@@ -463,19 +512,17 @@ def edit_machine(db: SessionLocal, machine_id: int, machine: schemas.MachineCrea
         db_machine.cost_center = machine.cost_center
         db_machine.description = machine.description
         db.commit()
+        _clear_cache(_machines_cache)
         return db_machine
     return {"detail": "Errore"}, 400
 
 
 def get_user_by_id(db: SessionLocal, user_id: int):
-    return db.query(models.User, models.Role.name.label('role'), models.Client.name.label('client_name'),
-                    models.Client.city.label('client_city')).join(models.Role,
-                                                                  models.User.role_id == models.Role.id).join(
-        models.Client, models.User.client_id == models.Client.id).filter(models.User.id == user_id).first()
+    return db.execute(_user_by_id, {"user_id": user_id}).first()
 
 
 def get_client_by_id(db: SessionLocal, client_id: int):
-    return db.query(models.Client).filter(models.Client.id == client_id).first()
+    return db.get(models.Client, client_id)
 
 
 def get_plant_by_id(db: SessionLocal, plant_id: int):
@@ -498,28 +545,24 @@ def get_machine_by_id(db: SessionLocal, machine_id: int):
 
 
 def create_user(db: SessionLocal, user: schemas.UserCreate):
-    db_user = db.query(models.User).filter(models.User.username == user.username).first()
-    if db_user:
-        raise HTTPException(status_code=400, detail="Username già registrato")
-    db_user = db.query(models.User).filter(models.User.email == user.email).first()
-    if db_user:
-        raise HTTPException(status_code=400, detail="Email già registrata")
     tmp_password = user.password if user.password else pwd.genword()
     tmp_password_hashed = auth.get_password_hash(tmp_password)
-    db_user = models.User(first_name=user.first_name, last_name=user.last_name, email=user.email,
-                          phone_number=user.phone_number, username=user.username, role_id=user.role_id,
-                          client_id=user.client_id, temp_password=tmp_password, password=tmp_password_hashed)
-    db.add(db_user)
+    created = db.execute(pg_insert(models.User).values(
+        first_name=user.first_name, last_name=user.last_name, email=user.email, phone_number=user.phone_number,
+        username=user.username, role_id=user.role_id, client_id=user.client_id, temp_password=tmp_password,
+        password=tmp_password_hashed).on_conflict_do_nothing().returning(models.User.id)).first()
+    if created is None:
+        if db.query(exists().where(models.User.username == user.username)).scalar():
+            raise HTTPException(status_code=400, detail="Username già registrato")
+        raise HTTPException(status_code=400, detail="Email già registrata")
     db.commit()
-    db.refresh(db_user)
-    return db_user
+    return {"id": created.id, "temp_password": tmp_password}
 
 
 def delete_user(db: SessionLocal, user_id: int, current_user_id: int):
-    user = db.query(models.User).get(user_id)
-    if user_id == 1 or user_id == current_user_id or db.query(models.User).filter(
-            models.Report.operator_id == user_id).first() or db.query(models.User).filter(
-        models.Report.supervisor_id == user_id).first():
+    user = db.get(models.User, user_id)
+    if user_id == 1 or user_id == current_user_id or db.query(exists().where(
+            or_(models.Report.operator_id == user_id, models.Report.supervisor_id == user_id))).scalar():
         raise HTTPException(status_code=403, detail="Non puoi eliminare questo utente")
     if not user:
         raise HTTPException(status_code=404, detail="Utente non trovato")
@@ -529,24 +572,24 @@ def delete_user(db: SessionLocal, user_id: int, current_user_id: int):
 
 
 def delete_client(db: SessionLocal, client_id: int):
-    client = db.query(models.Client).get(client_id)
-    exists = db.query(models.Commission).filter(models.Commission.client_id == client_id).first()
+    client = db.get(models.Client, client_id)
     if not client:
         raise HTTPException(status_code=404, detail="Cliente non trovato")
-    if exists:
+    try:
+        db.delete(client)
+        db.commit()
+        _clear_cache(_machines_cache)
+    except IntegrityError:
+        db.rollback()
         raise HTTPException(status_code=400, detail="Non puoi eliminare questo cliente")
-    db.delete(client)
-    db.commit()
     return {"detail": "Cliente eliminato"}
 
 
 def delete_commission(db: SessionLocal, commission_id: int):
-    commission = db.query(models.Commission).get(commission_id)
-    exists = db.query(models.Report).filter(models.Report.work_id == commission_id).filter(
-        models.Report.type == 'commission').first()
+    commission = db.get(models.Commission, commission_id)
     if not commission:
         raise HTTPException(status_code=404, detail="Commessa non trovata")
-    if exists:
+    if db.execute(_report_of_work, {"work_id": commission_id, "type": 'commission'}).scalar():
         raise HTTPException(status_code=400, detail="Non puoi eliminare questa commessa")
     db.delete(commission)
     db.commit()
@@ -554,84 +597,97 @@ def delete_commission(db: SessionLocal, commission_id: int):
 
 
 def delete_machine(db: SessionLocal, machine_id: int):
-    machine = db.query(models.Machine).get(machine_id)
-    exists = db.query(models.Report).filter(models.Report.work_id == machine_id).filter(
-        models.Report.type == 'machine').first()
+    machine = db.get(models.Machine, machine_id)
     if not machine:
         raise HTTPException(status_code=404, detail="Macchina non trovata")
-    if exists:
+    if db.execute(_report_of_work, {"work_id": machine_id, "type": 'machine'}).scalar():
+        raise HTTPException(status_code=400, detail="Non puoi eliminare questa macchina")
+    try:
+        db.delete(machine)
+        db.commit()
+        _clear_cache(_machines_cache)
+    except IntegrityError:
+        db.rollback()
         raise HTTPException(status_code=400, detail="Non puoi eliminare questa macchina")
-    db.delete(machine)
-    db.commit()
     return {"detail": "Macchina eliminata"}
 
 
 def delete_plant(db: SessionLocal, plant_id: int):
-    plant = db.query(models.Plant).get(plant_id)
+    plant = db.get(models.Plant, plant_id)
     if not plant:
         raise HTTPException(status_code=404, detail="Stabilimento non trovato")
-    exists = db.query(models.Machine).filter(models.Machine.plant_id == plant_id).first()
-    if exists:
+    try:
+        db.delete(plant)
+        db.commit()
+        _clear_cache(_machines_cache)
+    except IntegrityError:
+        db.rollback()
         raise HTTPException(status_code=400, detail="Non puoi eliminare questo stabilimento")
-    db.delete(plant)
-    db.commit()
     return {"detail": "Stabilimento eliminato"}
 
 
 def delete_report(db: SessionLocal, report_id: int, user_id: int):
-    report = db.query(models.Report).get(report_id)
-    user = db.query(models.User).get(user_id)
+    report = db.get(models.Report, report_id)
+    user = db.get(models.User, user_id)
     if not report:
         raise HTTPException(status_code=404, detail="Intervento non trovato")
     if report.operator_id != user_id and user.role_id != 1:
         raise HTTPException(status_code=403, detail="Non sei autorizzato a eliminare questo intervento")
     db.delete(report)
     db.commit()
+    _clear_cache(_months_cache)
     return {"detail": "Intervento eliminato"}
 
 
+def _report_values(report: schemas.ReportCreate, user_id: int):
+    values = report.dict(exclude={'date_created'})
+    if values['trip_kms'] == '':
+        values['trip_kms'] = '0.0'
+    if values['cost'] == '':
+        values['cost'] = '0.0'
+    values['operator_id'] = user_id
+    return values
+
+
 def create_report(db: SessionLocal, report: schemas.ReportCreate, user_id: int):
-    if report.trip_kms == '':
-        report.trip_kms = '0.0'
-    if report.cost == '':
-        report.cost = '0.0'
-    db_report = models.Report(date=report.date, intervention_duration=report.intervention_duration,
-                              intervention_type=report.intervention_type, type=report.type,
-                              intervention_location=report.intervention_location,
-                              work_id=report.work_id, description=report.description,
-                              supervisor_id=report.supervisor_id,
-                              notes=report.notes, trip_kms=report.trip_kms, cost=report.cost, operator_id=user_id,
-                              date_created=datetime.datetime.now(ZoneInfo("Europe/Rome")))
-    db.add(db_report)
+    values = _report_values(report, user_id)
+    created = db.execute(insert(models.Report).values(**values).returning(models.Report.id,
+                                                                          models.Report.date_created)).one()
     db.commit()
-    db.refresh(db_report)
-    return db_report
+    _clear_cache(_months_cache)
+    return {**values, "id": created.id, "date_created": created.date_created}
+
+
+def create_reports_bulk(db: SessionLocal, reports: List[schemas.ReportCreate], user_id: int):
+    if not reports:
+        return []
+    values = [_report_values(report, user_id) for report in reports]
+    created = db.execute(insert(models.Report).values(values).returning(*models.Report.__table__.columns)).all()
+    db.commit()
+    _clear_cache(_months_cache)
+    return created
 
 
 def create_commission(db: SessionLocal, commission: schemas.CommissionCreate):
-    db_commission = db.query(models.Commission).filter(models.Commission.code == commission.code).first()
-    if db_commission:
+    if (commission.code is None or "ix_commissions_code" in _missing_indexes) and db.query(
+            exists().where(models.Commission.code == commission.code)).scalar():
+        raise HTTPException(status_code=400, detail="Codice commessa già registrato")
+    created = db.execute(pg_insert(models.Commission).values(
+        code=commission.code, description=commission.description, client_id=commission.client_id, open=True
+    ).on_conflict_do_nothing().returning(*models.Commission.__table__.columns)).first()
+    if created is None:
         raise HTTPException(status_code=400, detail="Codice commessa già registrato")
-    db_commission = models.Commission(date_created=datetime.datetime.now(ZoneInfo("Europe/Rome")),
-                                      code=commission.code, description=commission.description,
-                                      client_id=commission.client_id, open=True)
-    db.add(db_commission)
     db.commit()
-    db.refresh(db_commission)
-    return db_commission
+    return created
 
 
 def create_client(db: SessionLocal, client: schemas.ClientCreate):
-    if db.query(models.Client).filter(models.Client.name == client.name).first():
+    created = db.execute(pg_insert(models.Client).values(**client.dict()).on_conflict_do_nothing(
+        index_elements=['name']).returning(*models.Client.__table__.columns)).first()
+    if created is None:
         raise HTTPException(status_code=400, detail="Cliente già registrato")
-    db_client = models.Client(name=client.name, address=client.address, city=client.city, email=client.email,
-                              phone_number=client.phone_number, contact=client.contact, province=client.province,
-                              cap=client.cap,
-                              date_created=datetime.datetime.now(ZoneInfo("Europe/Rome")))
-    db.add(db_client)
     db.commit()
-    db.refresh(db_client)
-    return db_client
+    return created
 
 
 def get_commissions(db: SessionLocal, client_id: Optional[int] = None):
@@ -653,22 +709,19 @@ def get_open_commissions(db: SessionLocal, client_id: Optional[int] = None):
 
 
 def create_plant(db: SessionLocal, plant: schemas.PlantCreate):
-    exists = db.query(models.Plant).filter(models.Plant.address == plant.address).first()
-    if exists:
+    if db.query(exists().where(models.Plant.address == plant.address)).scalar():
         raise HTTPException(status_code=400, detail="Esiste già uno stabilimento con questo indirizzo")
-    db_plant = models.Plant(date_created=datetime.datetime.now(ZoneInfo("Europe/Rome")), name=plant.name,
-                            address=plant.address,
+    db_plant = models.Plant(name=plant.name, address=plant.address,
                             province=plant.province, cap=plant.cap,
                             city=plant.city, email=plant.email, phone_number=plant.phone_number, contact=plant.contact,
                             client_id=plant.client_id)
     db.add(db_plant)
     db.commit()
-    db.refresh(db_plant)
     return db_plant
 
 
 def change_password(db: SessionLocal, old_password: str, new_password: str, user_id: int):
-    user = db.query(models.User).get(user_id)
+    user = db.get(models.User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="Utente non trovato")
     if len(new_password) < 8:
@@ -686,7 +739,7 @@ def change_password(db: SessionLocal, old_password: str, new_password: str, user
 
 
 def edit_user(db: SessionLocal, user_id: int, user: schemas.UserUpdate):
-    db_user = db.query(models.User).filter(models.User.id == user_id).first()
+    db_user = db.get(models.User, user_id)
     if db_user:
         db_user.email = user.email
         db_user.phone_number = user.phone_number
@@ -702,7 +755,7 @@ def get_supervisors_by_client(db: SessionLocal, client_id: int):
 
 
 def reset_password(db: SessionLocal, user_id: int):
-    user = db.query(models.User).get(user_id)
+    user = db.get(models.User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="Utente non trovato")
     tmp_password = pwd.genword()
@@ -710,44 +763,38 @@ def reset_password(db: SessionLocal, user_id: int):
     user.temp_password = tmp_password
     user.password = tmp_password_hashed
     db.commit()
-    db.refresh(user)
     return {"detail": "Password resettata", "password": tmp_password}
 
 
 def edit_report_email_date(db: SessionLocal, report_id: int, email_date: datetime.datetime):
-    db_report = db.query(models.Report).get(report_id)
+    db_report = db.get(models.Report, report_id)
     if not db_report:
         raise HTTPException(status_code=404, detail="Intervento non trovato")
     db_report.email_date = email_date
     db.commit()
-    db.refresh(db_report)
     return db_report
 
 
 def close_commission(db: SessionLocal, commission_id: int):
-    db_commission = db.query(models.Commission).get(commission_id)
+    db_commission = db.get(models.Commission, commission_id)
     if not db_commission:
         raise HTTPException(status_code=404, detail="Commessa non trovata")
     if not db_commission.open:
         db_commission.open = True
         db_commission.date_closed = None
         db.commit()
-        db.refresh(db_commission)
         return db_commission
     db_commission.open = False
     db_commission.date_closed = datetime.datetime.now(ZoneInfo("Europe/Rome"))
     db.commit()
-    db.refresh(db_commission)
     return db_commission
 
 
 def create_ticket(db: SessionLocal, ticket: schemas.TicketCreate, user_id: int):
     db_ticket = models.Ticket(title=ticket.title, status='open', priority=ticket.priority,
-                              date_created=datetime.datetime.now(ZoneInfo("Europe/Rome")),
                               requested_by=user_id, machine_id=ticket.machine_id, description=ticket.description)
     db.add(db_ticket)
     db.commit()
-    db.refresh(db_ticket)
     return db_ticket
 
 
@@ -757,44 +804,28 @@ def get_tickets(db: SessionLocal):
 
 
 def get_my_client(db: SessionLocal, user_id: int):
-    user = db.query(models.User).get(user_id)
+    user = db.get(models.User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="Utente non trovato")
-    client = db.query(models.Client).get(user.client_id)
+    client = db.get(models.Client, user.client_id)
     if not client:
         raise HTTPException(status_code=404, detail="L'utente non ha un cliente associato")
     return [client]
 
 
-def search_reports(db: SessionLocal, search: str):
+def search_reports(db: SessionLocal, search: str, limit: Optional[int] = None, offset: Optional[int] = None):
     search = '%' + search + '%'
-    return db.query(
-        models.Report,
-        models.Commission.id.label("commission_id"),
-        models.Commission.code.label("commission_code"),
-        models.Machine.id.label("machine_id"),
-        models.Machine.name.label("machine_name"),
-        models.Machine.brand.label("machine_brand"),
-        models.Machine.code.label("machine_code"),
-        models.Machine.cost_center.label("cost_center"),
-        models.User.id.label("operator_id"),
-        models.User.first_name,
-        models.User.last_name,
-        models.Client.id.label("client_id"),
-        models.Client.name.label("client_name"),
-        models.Plant.id.label("plant_id"),
-        models.Plant.city.label("plant_city"),
-        models.Plant.address.label("plant_address")
-    ).select_from(models.Report).outerjoin(
-        models.Commission,
-        and_(models.Report.type == "commission", models.Report.work_id == models.Commission.id)
-    ).outerjoin(
-        models.Machine,
-        and_(models.Report.type == "machine", models.Report.work_id == models.Machine.id)
-    ).outerjoin(models.Plant, models.Machine.plant_id == models.Plant.id).join(
-        models.Client,
-        or_(models.Plant.client_id == models.Client.id, models.Commission.client_id == models.Client.id)
-    ).join(models.User, models.Report.operator_id == models.User.id).filter(
+    commission_client = aliased(models.Client)
+    plant_client = aliased(models.Client)
+    query = db.query(models.Report).outerjoin(models.Report.commission).outerjoin(
+        models.Commission.client.of_type(commission_client)).outerjoin(models.Report.machine).outerjoin(
+        models.Machine.plant).outerjoin(models.Plant.client.of_type(plant_client)).join(models.Report.operator).options(
+        contains_eager(models.Report.commission).contains_eager(models.Commission.client.of_type(commission_client)),
+        contains_eager(models.Report.machine).contains_eager(models.Machine.plant).contains_eager(
+            models.Plant.client.of_type(plant_client)),
+        contains_eager(models.Report.operator)
+    ).filter(
+        or_(commission_client.id.isnot(None), plant_client.id.isnot(None)),
         or_(
             models.Report.description.ilike(search),
             models.Report.notes.ilike(search),
@@ -810,9 +841,12 @@ def search_reports(db: SessionLocal, search: str):
             models.Plant.name.ilike(search),
             models.Plant.city.ilike(search),
             models.Plant.address.ilike(search),
-            models.Client.name.ilike(search),
-            models.Client.city.ilike(search),
+            commission_client.name.ilike(search),
+            commission_client.city.ilike(search),
+            plant_client.name.ilike(search),
+            plant_client.city.ilike(search),
             models.User.first_name.ilike(search),
             models.User.last_name.ilike(search)
         )
-    ).order_by(models.Report.date).all()
+    ).order_by(models.Report.date, models.Report.id).limit(limit).offset(offset)
+    return [_report_row(report) for report in query.all()]
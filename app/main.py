@@ -30,6 +30,7 @@ load_dotenv()
 ACCESS_TOKEN_EXPIRE_HOURS = int(os.getenv("ACCESS_TOKEN_EXPIRE_HOURS"))
 
 models.Base.metadata.create_all(bind=engine)
+crud.create_indexes(engine)
 
 
 class Settings(BaseSettings):
@@ -69,7 +70,7 @@ conf = ConnectionConfig(
 
 
 @app.post("/token", response_model=schemas.Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: SessionLocal = Depends(get_db)):
+def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: SessionLocal = Depends(get_db)):
     user = db.query(models.User).filter(models.User.username == form_data.username).first()
     if not user or not user.verify_password(form_data.password):
         raise HTTPException(
@@ -144,8 +145,8 @@ def get_machines(db: SessionLocal = Depends(get_db), limit: Optional[int] = None
 
 @app.get("/reports")
 def get_reports(current_user: models.User = Depends(is_admin),
-                db: SessionLocal = Depends(get_db), limit: Optional[int] = None):
-    return crud.get_reports(db, limit=limit)
+                db: SessionLocal = Depends(get_db), limit: Optional[int] = None, offset: Optional[int] = None):
+    return crud.get_reports(db, limit=limit, offset=offset)
 
 
 @app.get("/tickets")
@@ -237,8 +238,7 @@ def get_report_by_id(report_id: int, db: SessionLocal = Depends(get_db),
     report = crud.get_report_by_id(db, report_id=report_id)
     if report is None:
         raise HTTPException(status_code=404, detail="Intervento non trovato")
-    if db.query(models.Report).filter(
-            models.Report.id == report_id).first().operator_id != current_user.id and current_user.role_id != 1:
+    if report["Report"]["operator_id"] != current_user.id and current_user.role_id != 1:
         raise HTTPException(status_code=403, detail="Non sei autorizzato a vedere questo intervento")
     return report
 
@@ -442,14 +442,14 @@ def get_csv_interval_commission_reports(start_date: str, end_date: str, db: Sess
 
 
 @app.get("/me")
-async def get_profile(db: SessionLocal = Depends(get_db), current_user: schemas.User = Depends(get_current_user)):
+def get_profile(db: SessionLocal = Depends(get_db), current_user: schemas.User = Depends(get_current_user)):
     return crud.get_user_by_id(db, user_id=current_user.id)
 
 
 @app.get("/me/reports")
 def get_my_reports(db: SessionLocal = Depends(get_db), current_user: schemas.User = Depends(get_current_user),
-                   limit: Optional[int] = None):
-    return crud.get_reports(db=db, user_id=current_user.id, limit=limit)
+                   limit: Optional[int] = None, offset: Optional[int] = None):
+    return crud.get_reports(db=db, user_id=current_user.id, limit=limit, offset=offset)
 
 
 @app.get("/user/{user_id}")
@@ -515,6 +515,12 @@ def create_report(report: schemas.ReportCreate, current_user: models.User = Depe
     return crud.create_report(db=db, report=report, user_id=current_user.id)
 
 
+@app.post("/reports/bulk", response_model=list[schemas.Report])
+def create_reports_bulk(reports: list[schemas.ReportCreate], current_user: models.User = Depends(get_current_user),
+                        db: SessionLocal = Depends(get_db)):
+    return crud.create_reports_bulk(db=db, reports=reports, user_id=current_user.id)
+
+
 @app.post("/users/create", response_model=schemas.UserRegister)
 def create_user(user: schemas.UserCreate, db: SessionLocal = Depends(get_db),
                 current_user: models.User = Depends(is_admin)):
@@ -735,20 +741,22 @@ def upload_xml(file: UploadFile):
 
 
 @app.post("/send-email")
-async def send_in_background(report_id: int,
-                             background_tasks: BackgroundTasks,
-                             email: EmailStr = Form(...),
-                             file: UploadFile = File(...),
-                             current_user: models.User = Depends(is_admin),
-                             db: SessionLocal = Depends(get_db)) -> Response:
+def send_in_background(report_id: int,
+                       background_tasks: BackgroundTasks,
+                       email: EmailStr = Form(...),
+                       file: UploadFile = File(...),
+                       current_user: models.User = Depends(is_admin),
+                       db: SessionLocal = Depends(get_db)) -> Response:
     report = crud.get_report_by_id(db=db, report_id=report_id)
+    if report is None:
+        raise HTTPException(status_code=404, detail="Intervento non trovato")
     message = MessageSchema(
-        subject=report.last_name.upper() + ' ' + report.first_name.upper() + ' - Intervento ' + report.client_name + ' ' + report.Report.date.strftime(
+        subject=report["last_name"].upper() + ' ' + report["first_name"].upper() + ' - Intervento ' + report["client_name"] + ' ' + report["Report"]["date"].strftime(
             '%d/%m/%Y'),
         recipients=[email],
-        body='<div style="padding-bottom: 20px;">Buongiorno,<br> in allegato l\'intervento di ' + report.last_name.upper() + ' '
-             + report.first_name.upper() + ' in data ' + report.Report.date.strftime(
-            '%d/%m/%Y') + ' presso ' + report.client_name + '.<br><br>'
+        body='<div style="padding-bottom: 20px;">Buongiorno,<br> in allegato l\'intervento di ' + report["last_name"].upper() + ' '
+             + report["first_name"].upper() + ' in data ' + report["Report"]["date"].strftime(
+            '%d/%m/%Y') + ' presso ' + report["client_name"] + '.<br><br>'
                                                             'Il presente intervento è da ritenersi accettato se '
                                                             'non vi saranno comunicazioni entro 3 giorni '
                                                             'lavorativi.<br><br>' +
@@ -777,7 +785,8 @@ async def send_in_background(report_id: int,
 
 
 @app.get("/reports/search")
-def search_reports(q: str, db: SessionLocal = Depends(get_db), current_user: models.User = Depends(is_admin)):
+def search_reports(q: str, db: SessionLocal = Depends(get_db), current_user: models.User = Depends(is_admin),
+                   limit: Optional[int] = None, offset: Optional[int] = None):
     if not q:
-        return crud.get_reports(db=db, limit=100)
-    return crud.search_reports(db=db, search=q)
+        return crud.get_reports(db=db, limit=limit or 100, offset=offset)
+    return crud.search_reports(db=db, search=q, limit=limit, offset=offset)
@@ -1,7 +1,7 @@
 from passlib.context import CryptContext
 from pydantic import BaseModel
-from sqlalchemy import Column, Integer, String, ForeignKey, Date, DateTime, Boolean
-from sqlalchemy.orm import deferred
+from sqlalchemy import Column, Integer, String, ForeignKey, Date, DateTime, Boolean, Index, func
+from sqlalchemy.orm import deferred, relationship
 
 from app.database import Base
 
@@ -11,8 +11,8 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 class User(Base):
     __tablename__ = "operators"
     id = Column(Integer, primary_key=True, index=True, unique=True)
-    role_id = Column(Integer, ForeignKey("roles.id"))
-    client_id = Column(Integer, ForeignKey("clients.id"))
+    role_id = Column(Integer, ForeignKey("roles.id", ondelete="RESTRICT"))
+    client_id = Column(Integer, ForeignKey("clients.id", ondelete="RESTRICT"))
     first_name = Column(String)
     last_name = Column(String)
     email = Column(String, unique=True, index=True)
@@ -36,13 +36,15 @@ class Client(Base):
     email = Column(String)
     contact = Column(String)
     phone_number = Column(String)
-    date_created = Column(DateTime)
+    date_created = Column(DateTime, default=func.now(), server_default=func.now())
+
+    __mapper_args__ = {"eager_defaults": True}
 
 
 class Plant(Base):
     __tablename__ = "plants"
     id = Column(Integer, primary_key=True, index=True, unique=True)
-    client_id = Column(Integer, ForeignKey("clients.id"))
+    client_id = Column(Integer, ForeignKey("clients.id", ondelete="RESTRICT"))
     name = Column(String)
     city = Column(String)
     province = Column(String)
@@ -51,13 +53,17 @@ class Plant(Base):
     email = Column(String)
     contact = Column(String)
     phone_number = Column(String)
-    date_created = Column(DateTime)
+    date_created = Column(DateTime, default=func.now(), server_default=func.now())
+
+    client = relationship("Client")
+
+    __mapper_args__ = {"eager_defaults": True}
 
 
 class Machine(Base):
     __tablename__ = "machines"
     id = Column(Integer, primary_key=True, index=True, unique=True)
-    plant_id = Column(Integer, ForeignKey("plants.id"))
+    plant_id = Column(Integer, ForeignKey("plants.id", ondelete="RESTRICT"))
     robotic_island = Column(String)
     code = Column(String)
     name = Column(String)
@@ -67,38 +73,59 @@ class Machine(Base):
     production_year = Column(String)
     cost_center = Column(String)
     description = Column(String)
-    date_created = Column(DateTime)
+    date_created = Column(DateTime, default=func.now(), server_default=func.now())
+
+    plant = relationship("Plant")
+
+    __mapper_args__ = {"eager_defaults": True}
 
 
 class Commission(Base):
     __tablename__ = "commissions"
     id = Column(Integer, primary_key=True, index=True, unique=True)
-    client_id = Column(Integer, ForeignKey("clients.id"))
-    code = Column(String)
+    client_id = Column(Integer, ForeignKey("clients.id", ondelete="RESTRICT"))
+    code = Column(String, unique=True, index=True)
     description = Column(String)
     open = Column(Boolean)
-    date_created = Column(DateTime)
+    date_created = Column(DateTime, default=func.now(), server_default=func.now())
     date_closed = Column(DateTime)
 
+    client = relationship("Client")
+
+    __mapper_args__ = {"eager_defaults": True}
+
 
 class Report(Base):
     __tablename__ = "reports"
     id = Column(Integer, primary_key=True, index=True, unique=True)
-    operator_id = Column(Integer, ForeignKey("operators.id"))
+    operator_id = Column(Integer, ForeignKey("operators.id", ondelete="RESTRICT"))
     work_id = Column(Integer)  # might be either a machine or a commission
     type = Column(String)  # either machine or commission
-    date = Column(Date)
+    date = Column(Date, index=True)
     intervention_duration = Column(String)
     intervention_type = Column(String)
     intervention_location = Column(String)
-    supervisor_id = Column(Integer, ForeignKey("operators.id"))
+    supervisor_id = Column(Integer, ForeignKey("operators.id", ondelete="RESTRICT"))
     description = Column(String)
     notes = Column(String)
     trip_kms = Column(String)
     cost = Column(String)
-    date_created = Column(DateTime)
+    date_created = Column(DateTime, default=func.now(), server_default=func.now())
     email_date = Column(DateTime)
 
+    operator = relationship("User", foreign_keys=[operator_id])
+    supervisor = relationship("User", foreign_keys=[supervisor_id])
+    commission = relationship("Commission", viewonly=True,
+                              primaryjoin="and_(Report.type == 'commission', foreign(Report.work_id) == Commission.id)")
+    machine = relationship("Machine", viewonly=True,
+                           primaryjoin="and_(Report.type == 'machine', foreign(Report.work_id) == Machine.id)")
+
+    __table_args__ = (
+        Index('ix_report_op_date_id', operator_id, date.desc(), id.desc(), work_id, type),
+        Index('ix_report_work_type', work_id, type),
+    )
+    __mapper_args__ = {"eager_defaults": True}
+
 
 class InterventionType(Base):
     __tablename__ = "intervention_types"
@@ -124,13 +151,15 @@ class Ticket(Base):
     title = Column(String)
     status = Column(String)
     priority = Column(String)
-    date_created = Column(DateTime)
+    date_created = Column(DateTime, default=func.now(), server_default=func.now())
     date_edited = Column(DateTime)
     date_closed = Column(DateTime)
-    requested_by = Column(Integer, ForeignKey("operators.id"))
-    machine_id = Column(Integer, ForeignKey("machines.id"))
+    requested_by = Column(Integer, ForeignKey("operators.id", ondelete="RESTRICT"))
+    machine_id = Column(Integer, ForeignKey("machines.id", ondelete="RESTRICT"))
     description = Column(String)
 
+    __mapper_args__ = {"eager_defaults": True}
+
 
 class Password(BaseModel):
     old_password: str